@@ -1,9 +1,37 @@
+import logging
+import time
 import streamlit as st
-import folium
-from streamlit_folium import st_folium
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+import streamlit.components.v1 as components
 from trip_components import LLMHandler, GeocodingHandler, MapHandler
 
+@st.cache_resource
+def configure_logging():
+    """Attach the log file handler once per process, not on every rerun."""
+    handler = RotatingFileHandler("trip_planner.log", maxBytes=1_000_000, backupCount=3, delay=True)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger = logging.getLogger("trip_components")
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+@st.cache_resource
+def get_handlers():
+    """Build the handlers once per process instead of on every rerun."""
+    return LLMHandler(), GeocodingHandler(), MapHandler()
+
+@st.cache_data(max_entries=32)
+def build_map_html(spots_key):
+    """Render the Folium map to static HTML once per distinct set of spots."""
+    spots = [
+        {'name': name, 'remarks': remarks, 'coordinates': {'lat': lat, 'lon': lon}}
+        for name, remarks, lat, lon in spots_key
+    ]
+    _, _, map_handler = get_handlers()
+    return map_handler.create_map(spots).get_root().render()
+
 def main():
+    configure_logging()
     st.title("🗺️ AI Trip Planner")
     st.write("Plan your perfect trip with AI-powered recommendations!")
     
@@ -14,9 +42,7 @@ def main():
         st.session_state.current_location = None
     
     # Initialize handlers
-    llm_handler = LLMHandler()
-    geocoding_handler = GeocodingHandler()
-    map_handler = MapHandler()
+    llm_handler, geocoding_handler, _ = get_handlers()
     
     # User Input Form
     with st.form("trip_form"):
@@ -38,8 +64,30 @@ def main():
     # Process and Display Results
     if submitted and location:
         with st.spinner("Finding amazing spots for you..."):
-            # Get LLM recommendations
-            spots_data = llm_handler.get_recommendations(location, duration, category, num_spots)
+            # Show the raw JSON as it streams in, then parse once complete.
+            # Redraw at most every 100 ms rather than once per token
+            preview = st.empty()
+            streamed = []
+            last_redraw = 0.0
+            
+            def show_token(token):
+                nonlocal last_redraw
+                streamed.append(token)
+                now = time.monotonic()
+                if now - last_redraw >= 0.1:
+                    last_redraw = now
+                    preview.code("".join(streamed), language="json")
+            
+            # Resolve the destination in the background while the LLM runs;
+            # get_coordinates then finds it in the city cache
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(geocoding_handler.locate_city, location)
+                
+                # Get LLM recommendations
+                spots_data = llm_handler.get_recommendations(
+                    location, duration, category, num_spots, on_token=show_token
+                )
+            preview.empty()
             
             if spots_data:
                 # Get coordinates for each spot
@@ -61,8 +109,12 @@ def main():
         st.subheader(f"Recommended spots in {st.session_state.current_location}")
         
         # Create and display map
-        map_obj = map_handler.create_map(st.session_state.spots_with_coords)
-        map_data = st_folium(map_obj, width=700, height=500, key="trip_map")
+        spots_key = tuple(
+            (spot['name'], spot['remarks'], spot['coordinates']['lat'], spot['coordinates']['lon'])
+            for spot in st.session_state.spots_with_coords
+        )
+        # Static iframe: the map sends no interaction state back to the app
+        components.html(build_map_html(spots_key), width=700, height=500)
         
         # Display spot details
         st.subheader("Spot Details")
@@ -1,20 +1,81 @@
 import os
+import abc
 import json
+import logging
+import math
+import random
+import re
 import folium
+import functools
+import itertools
 import requests
+import threading
 import time
-from langchain.llms import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.cache import SQLiteCache
+from langchain.schema import Generation
 from dotenv import load_dotenv
 
+# orjson decodes straight from bytes and is several times faster than json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 load_dotenv()
 email = os.getenv('USER_EMAIL')
 
+logger = logging.getLogger(__name__)
+
+# Persist LLM responses keyed on the normalised trip inputs, so resubmitting
+# the same trip is answered from disk instead of another API call. Written by
+# LLMHandler only after a response parses, so a bad one is never replayed
+_llm_cache = SQLiteCache(database_path=".langchain.db")
+# Identifies the model settings in the cache key; bump when _get_llm changes
+LLM_CACHE_KEY = "gpt-4o-mini/temperature=0/json_object"
+
+# Geocoding results shared by every handler instance, so Streamlit reruns
+# and repeated searches for the same city skip the network entirely
+_geocode_cache = {}
+_geocode_cache_lock = threading.Lock()
+GEOCODE_CACHE_SIZE = 1024
+_city_cache = {}
+_city_cache_lock = threading.Lock()
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """Forwards each generated token to a callback as it arrives."""
+    
+    def __init__(self, on_token):
+        self.on_token = on_token
+    
+    def on_llm_new_token(self, token, **kwargs):
+        self.on_token(token)
+
+@functools.lru_cache(maxsize=None)
+def _get_llm():
+    # One OpenAI chat model (requires OPENAI_API_KEY environment variable) per
+    # process, so its HTTP connection pool is shared by every handler.
+    # Deterministic sampling, since identical prompts are served from cache;
+    # JSON mode guarantees a parseable object without format instructions
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0,
+        streaming=True,
+        max_retries=2,
+        request_timeout=30,
+        model_kwargs={"response_format": {"type": "json_object"}}
+    )
+
 class LLMHandler:
     def __init__(self):
-        # Initialize OpenAI LLM (requires OPENAI_API_KEY environment variable)
-        self.llm = OpenAI(temperature=0.7)
+        self.llm = _get_llm()
         
         # Create prompt template
         self.prompt_template = PromptTemplate(
@@ -22,85 +83,351 @@ class LLMHandler:
             template="""
             You are a travel expert. Recommend {num_spots} specific {category} spots in {location} for a {duration} trip.
             
-            Return your response as JSON format with this structure:
-            [
-                {{
-                    "name": "Spot Name",
-                    "type": "{category}",
-                    "remarks": "Brief description and why it's recommended"
-                }}
-            ]
-            
-            Only return the JSON array, no additional text.
+            Respond with a JSON object {{"spots": [...]}} where each spot has
+            "name", "type" ("{category}"), "remarks" (why it's recommended),
+            and accurate "lat"/"lon" in decimal degrees.
             """
         )
         
-        self.chain = LLMChain(llm=self.llm, prompt=self.prompt_template)
+        # Formatted prompts memoized by their inputs, so resubmitting a trip
+        # skips prompt assembly as well as the (cached) LLM call
+        self.format_prompt = functools.lru_cache(maxsize=128)(self.prompt_template.format)
+    
+    def _parse_spots(self, text):
+        # Reject anything the UI can't render, so it is never cached
+        spots_data = json_loads(text)['spots']
+        if not isinstance(spots_data, list) or not spots_data:
+            raise ValueError("expected a non-empty list of spots")
+        for spot in spots_data:
+            if not isinstance(spot, dict) or 'name' not in spot or 'remarks' not in spot:
+                raise ValueError(f"malformed spot: {spot!r}")
+        return spots_data
     
-    def get_recommendations(self, location, duration, category, num_spots):
+    def get_recommendations(self, location, duration, category, num_spots, on_token=None):
+        # Normalise the destination for the cache key only, so "Paris " and
+        # "paris" share an entry while the model still sees the user's casing
+        location = " ".join(location.split())
+        cache_key = json.dumps([location.casefold(), duration, category, num_spots])
+        
+        # Stream tokens to the caller while generating; cache hits skip this
+        callbacks = [TokenStreamHandler(on_token)] if on_token else None
+        
         try:
-            response = self.chain.run(
+            prompt = self.format_prompt(
                 location=location,
                 duration=duration,
                 category=category,
                 num_spots=num_spots
             )
+            cached = _llm_cache.lookup(cache_key, LLM_CACHE_KEY)
+            if cached:
+                return self._parse_spots(cached[0].text)
             
-            # Parse JSON response
-            spots_data = json.loads(response.strip())
+            response = self.llm.invoke(prompt, config={'callbacks': callbacks})
+            spots_data = self._parse_spots(response.content)
+            
+            # Only cache responses that parsed, so a bad one can be retried
+            _llm_cache.update(cache_key, LLM_CACHE_KEY, [Generation(text=response.content)])
             return spots_data
             
         except Exception as e:
-            print(f"LLM Error: {e}")
+            logger.warning("LLM Error: %s", e)
+            return None
+
+class GeocodingBackend(abc.ABC):
+    """Interface for the geocoding services GeocodingHandler can query."""
+    # Minimum seconds between request starts (0 means no limit)
+    min_interval = 0.0
+    max_workers = 5
+    
+    @abc.abstractmethod
+    def search_city(self, session, location):
+        """Return {'lat', 'lon', 'bbox', 'country_code'} for a destination, or None.
+        
+        bbox is (west, south, east, north), or None when the service gives no extent.
+        """
+    
+    @abc.abstractmethod
+    def search_spot(self, session, spot_name, location, city):
+        """Return {'lat', 'lon'} for a spot, scoped to city when given, or None."""
+
+class NominatimBackend(GeocodingBackend):
+    # Using OpenStreetMap Nominatim (free geocoding service);
+    # its usage policy allows at most one request per second
+    base_url = "https://nominatim.openstreetmap.org/search"
+    min_interval = 1.0
+    
+    def _search(self, session, params):
+        params['format'] = 'json'
+        params['limit'] = 1
+        response = session.get(self.base_url, params=params, timeout=10)
+        response.raise_for_status()
+        data = json_loads(response.content)
+        return data[0] if data else None
+    
+    def search_city(self, session, location):
+        place = self._search(session, {'q': location, 'addressdetails': 1})
+        if not place:
+            return None
+        
+        # Nominatim returns boundingbox as [south, north, west, east]
+        south, north, west, east = (float(v) for v in place['boundingbox'])
+        return {
+            'lat': float(place['lat']),
+            'lon': float(place['lon']),
+            'bbox': (west, south, east, north),
+            'country_code': place.get('address', {}).get('country_code')
+        }
+    
+    def search_spot(self, session, spot_name, location, city):
+        params = {'q': f"{spot_name}, {location}", 'dedupe': 1}
+        
+        # Scope the search to the destination so one query is enough
+        if city and city['bbox']:
+            params['q'] = spot_name
+            params['viewbox'] = ",".join(str(v) for v in city['bbox'])
+            params['bounded'] = 1
+            if city['country_code']:
+                params['countrycodes'] = city['country_code']
+        
+        place = self._search(session, params)
+        if not place:
+            return None
+        return {'lat': float(place['lat']), 'lon': float(place['lon'])}
+
+class PhotonBackend(GeocodingBackend):
+    # Komoot's Photon has no per-second request policy, so spot lookups
+    # run fully in parallel over the pooled session
+    max_workers = 8
+    
+    def __init__(self, host="photon.komoot.io"):
+        self.base_url = f"https://{host}/api/"
+    
+    def _search(self, session, params):
+        params['limit'] = 1
+        response = session.get(self.base_url, params=params, timeout=10)
+        response.raise_for_status()
+        features = json_loads(response.content).get('features')
+        return features[0] if features else None
+    
+    def search_city(self, session, location):
+        feature = self._search(session, {'q': location})
+        if not feature:
+            return None
+        
+        lon, lat = feature['geometry']['coordinates']
+        props = feature['properties']
+        # Photon extent is [west, north, east, south]; points have none, and
+        # a zero-area bbox would filter out every spot
+        bbox = None
+        if 'extent' in props:
+            west, north, east, south = props['extent']
+            bbox = (west, south, east, north)
+        return {
+            'lat': lat,
+            'lon': lon,
+            'bbox': bbox,
+            'country_code': props.get('countrycode', '').lower() or None
+        }
+    
+    def search_spot(self, session, spot_name, location, city):
+        params = {'q': f"{spot_name}, {location}"}
+        
+        # Bias towards the destination's centre, bounded by its extent if known
+        if city:
+            params['q'] = spot_name
+            params['lat'] = city['lat']
+            params['lon'] = city['lon']
+            if city['bbox']:
+                params['bbox'] = ",".join(str(v) for v in city['bbox'])
+        
+        feature = self._search(session, params)
+        if not feature:
             return None
+        lon, lat = feature['geometry']['coordinates']
+        return {'lat': lat, 'lon': lon}
+
+GEOCODING_BACKENDS = {
+    'nominatim': NominatimBackend,
+    'photon': PhotonBackend,
+}
 
 class GeocodingHandler:
-    def __init__(self):
-        # Using OpenStreetMap Nominatim (free geocoding service)
-        self.base_url = "https://nominatim.openstreetmap.org/search"
+    # Max distance (degrees) outside the destination's bbox (or from its centre
+    # when it has none) for LLM coordinates to be trusted
+    max_city_offset = 0.5
+    # Spread (degrees) for spots placed on the city centre so markers don't stack
+    centroid_jitter = 0.001
+
+    def __init__(self, backend=None):
+        # Backend is chosen by the GEOCODER environment variable unless given
+        if backend is None:
+            name = os.getenv('GEOCODER', 'nominatim').lower()
+            if name not in GEOCODING_BACKENDS:
+                raise ValueError(
+                    f"Unknown GEOCODER {name!r}; expected one of: {', '.join(GEOCODING_BACKENDS)}"
+                )
+            backend = GEOCODING_BACKENDS[name]()
+        self.backend = backend
         self.headers = {
         'User-Agent': f'trip_planner/1.0 ({email})'  # Required!
     }
+        
+        # Keep-alive pooled session so queries reuse one TLS connection
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=retry)
+        self.session.mount("https://", adapter)
+        
+        self._rate_lock = threading.Lock()
+        self._next_slot = 0.0
     
-    def get_coordinates(self, spots_data, location):
-        spots_with_coords = []
+    def _wait_for_slot(self):
+        # Reserve the next free slot under the lock, then sleep outside it so
+        # requests start >= min_interval apart but overlap while in flight
+        if not self.backend.min_interval:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.backend.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+    
+    def _is_destination(self, spot_name, location):
+        # Match whole words only, so "Nice" doesn't match inside "Venice"
+        spot, dest = spot_name.strip().lower(), location.strip().lower()
+        return bool(spot) and (
+            re.search(rf'\b{re.escape(spot)}\b', dest) is not None
+            or SequenceMatcher(None, spot, dest).ratio() > 0.85
+        )
+    
+    def _geocode_spot(self, spot_name, location, city):
+        # A "spot" that is just the destination itself resolves to the city centre
+        if city and self._is_destination(spot_name, location):
+            return {
+                'lat': city['lat'] + random.uniform(-self.centroid_jitter, self.centroid_jitter),
+                'lon': city['lon'] + random.uniform(-self.centroid_jitter, self.centroid_jitter)
+            }
         
-        for spot in spots_data:
-            try:
-                # Search for coordinates
-                params = {
-                    'q': f"{spot['name']}, {location}",
-                    'format': 'json',
-                    'limit': 1
-                }
-                
-                response = requests.get(self.base_url, params=params, headers=self.headers)
-                response.raise_for_status()
-                data = response.json()
-                time.sleep(1)
+        key = (spot_name.strip().lower(), location.strip().lower())
+        with _geocode_cache_lock:
+            if key in _geocode_cache:
+                return _geocode_cache[key]
+        
+        coords = self._fetch_coordinates(spot_name, location, city)
+        
+        # Only cache hits so transient failures are retried next time
+        if coords:
+            with _geocode_cache_lock:
+                if len(_geocode_cache) >= GEOCODE_CACHE_SIZE:
+                    del _geocode_cache[next(iter(_geocode_cache))]
+                _geocode_cache[key] = coords
+        
+        return coords
+    
+    def _fetch_coordinates(self, spot_name, location, city):
+        try:
+            self._wait_for_slot()
+            coords = self.backend.search_spot(self.session, spot_name, location, city)
+            
+            # Spots just outside the destination's bbox (e.g. Versailles for
+            # Paris) miss the scoped search; retry once unscoped
+            if coords is None and city:
+                self._wait_for_slot()
+                coords = self.backend.search_spot(self.session, spot_name, location, None)
+            return coords
                 
-                if data:
-                    coords = {
-                        'lat': float(data[0]['lat']),
-                        'lon': float(data[0]['lon'])
-                    }
-                    
-                    spot_with_coords = spot.copy()
-                    spot_with_coords['coordinates'] = coords
-                    spots_with_coords.append(spot_with_coords)
-                    
-            except Exception as e:
-                print(f"Geocoding error for {spot['name']}: {e}")
-                continue
+        except Exception as e:
+            logger.warning("Geocoding error for %s: %s", spot_name, e)
+        
+        return None
+    
+    def locate_city(self, location):
+        key = location.strip().lower()
+        with _city_cache_lock:
+            if key in _city_cache:
+                return _city_cache[key]
+        
+        try:
+            self._wait_for_slot()
+            city = self.backend.search_city(self.session, location)
+            
+        except Exception as e:
+            logger.warning("Geocoding error for %s: %s", location, e)
+            return None
+        
+        # Only cache hits so an unresolved destination is retried next time
+        if city:
+            with _city_cache_lock:
+                if len(_city_cache) >= GEOCODE_CACHE_SIZE:
+                    del _city_cache[next(iter(_city_cache))]
+                _city_cache[key] = city
+        
+        return city
+    
+    def _llm_coordinates(self, spot, city):
+        # Trust coordinates from the LLM only if they land near the destination
+        if not city:
+            return None
+        try:
+            lat, lon = float(spot['lat']), float(spot['lon'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        # NaN/inf would slip through the range comparisons below
+        if not (math.isfinite(lat) and math.isfinite(lon)):
+            return None
+        if city['bbox']:
+            west, south, east, north = city['bbox']
+        else:
+            west, south, east, north = city['lon'], city['lat'], city['lon'], city['lat']
+        pad = self.max_city_offset
+        if (lat < south - pad or lat > north + pad
+                or lon < west - pad or lon > east + pad):
+            return None
+        return {'lat': lat, 'lon': lon}
+    
+    def get_coordinates(self, spots_data, location):
+        if not spots_data:
+            return []
+        
+        # Resolve the destination once; every spot lookup below is scoped by it
+        city = self.locate_city(location)
+        results = [self._llm_coordinates(spot, city) for spot in spots_data]
+        
+        # Geocode the spots the LLM couldn't place, concurrently
+        missing = [i for i, coords in enumerate(results) if coords is None]
+        if missing:
+            names = [spots_data[i]['name'] for i in missing]
+            workers = min(len(names), self.backend.max_workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                fetched = executor.map(
+                    self._geocode_spot, names, [location] * len(names), [city] * len(names)
+                )
+                for i, coords in zip(missing, fetched):
+                    results[i] = coords
+        
+        spots_with_coords = []
+        for spot, coords in zip(spots_data, results):
+            if coords:
+                # The LLM's list isn't reused, so annotate spots in place
+                spot['coordinates'] = coords
+                spots_with_coords.append(spot)
         
         return spots_with_coords
 
+MARKER_COLORS = ['red', 'blue', 'green', 'purple', 'orange']
+
+# Popup body shared by every marker
+POPUP_HTML = "<b>{name}</b><br>{remarks}".format
+
 class MapHandler:
     def create_map(self, spots_with_coords):
         if not spots_with_coords:
             return None
         
-        # Calculate center point
+        # Calculate center point (plain sum/len: at most a handful of spots)
         lats = [spot['coordinates']['lat'] for spot in spots_with_coords]
         lons = [spot['coordinates']['lon'] for spot in spots_with_coords]
         
@@ -114,21 +441,23 @@ class MapHandler:
             tiles='OpenStreetMap'
         )
         
-        # Add markers for each spot
-        colors = ['red', 'blue', 'green', 'purple', 'orange']
+        # Add markers for each spot to one layer so Leaflet renders them together
+        spots_layer = folium.FeatureGroup(name='spots')
+        spots_layer.add_to(m)
         
-        for i, spot in enumerate(spots_with_coords):
+        for spot, color in zip(spots_with_coords, itertools.cycle(MARKER_COLORS)):
             coords = spot['coordinates']
-            color = colors[i % len(colors)]
             
             folium.Marker(
                 location=[coords['lat'], coords['lon']],
+                # lazy: popup HTML is only rendered when the marker is clicked
                 popup=folium.Popup(
-                    f"<b>{spot['name']}</b><br>{spot['remarks']}",
-                    max_width=300
+                    POPUP_HTML(name=spot['name'], remarks=spot['remarks']),
+                    max_width=300,
+                    lazy=True
                 ),
                 tooltip=spot['name'],
                 icon=folium.Icon(color=color, icon='info-sign')
-            ).add_to(m)
+            ).add_to(spots_layer)
         
         return m
\ No newline at end of file